@@ -1,23 +1,34 @@
-from typing import List, Dict
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+from collections import deque
+from typing import Deque, Tuple
 from uuid import uuid4
 
+import uvicorn
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from pydantic import BaseModel
+from redis import RedisError
 from starlette.websockets import WebSocket, WebSocketDisconnect
 
 from src.config import Config
-from fastapi.responses import JSONResponse
-from langchain_core.documents import Document
+from fastapi.responses import ORJSONResponse
 
 from src.schema import UploadResponse
-from src.services import WebsocketManager, PineconeService
-from src.utils import llm_chat_chain, extract_pdf_text, extract_txt_text, extract_docx_text, preprocess_text, chunk_text
+from src.services import WebsocketManager, PineconeService, QueryCache, EmbeddingCache, CacheGeneration
+from src.utils import llm_chat_stream, extract_pdf_text, extract_txt_text, extract_docx_text, preprocess_text, chunk_text, \
+    embed_documents, upsert_vectors
+
+logger = logging.getLogger(__name__)
 
 # Initialize FastAPI app
 app = FastAPI(
     title="RAG Service",
     description="File upload and live chat service using Retrieval-Augmented Generation.",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
 
@@ -28,7 +39,8 @@ async def startup_event():
     Initialize Pinecone index on FastAPI server startup.
     """
     pinecone_service = PineconeService(pinecone_api_key=Config.PINECONE_API_KEY, index_name=Config.INDEX_NAME,
-                                       embedding_client=Config.embedding_client)
+                                       embedding_client=Config.embedding_client,
+                                       pod_type=Config.PINECONE_POD_TYPE, environment=Config.PINECONE_ENVIRONMENT)
     # Initialize Pinecone index and store it in Config
     if Config.pinecone_client is None:
         Config.pinecone_client = pinecone_service.initialize_pinecone()
@@ -37,11 +49,62 @@ async def startup_event():
     if Config.pinecone_vector_store_client is None:
         Config.pinecone_vector_store_client = pinecone_service.pinecone_vector_store_client(Config.pinecone_client)
 
+    # Initialize the embedding cache if Redis is configured
+    if Config.embedding_cache is None and Config.REDIS_URL:
+        Config.embedding_cache = EmbeddingCache(redis_url=Config.REDIS_URL, embedding_client=Config.embedding_client,
+                                                ttl=Config.EMBEDDING_CACHE_TTL,
+                                                socket_timeout=Config.REDIS_SOCKET_TIMEOUT,
+                                                socket_connect_timeout=Config.REDIS_CONNECT_TIMEOUT)
+
+    # Share query cache invalidations between workers if Redis is configured
+    if Config.query_cache_generation is None and Config.REDIS_URL:
+        Config.query_cache_generation = CacheGeneration(redis_url=Config.REDIS_URL,
+                                                        socket_timeout=Config.REDIS_SOCKET_TIMEOUT,
+                                                        socket_connect_timeout=Config.REDIS_CONNECT_TIMEOUT)
+
+
+# Semantic cache for similarity search results. With several workers an upload can only invalidate
+# the caches of the other workers through Redis, so without it the cache is disabled
+query_cache_size = Config.QUERY_CACHE_MAX_SIZE
+if Config.WORKERS > 1 and not Config.REDIS_URL:
+    logger.warning("Query cache disabled: running %d workers without REDIS_URL", Config.WORKERS)
+    query_cache_size = 0
+query_cache = QueryCache(max_size=query_cache_size, ttl=Config.QUERY_CACHE_TTL,
+                         threshold=Config.QUERY_CACHE_THRESHOLD)
+
+
+async def sync_query_cache() -> bool:
+    """
+    Drops the query cache if another worker invalidated it since the last lookup.
+    Returns False if the cache can't be trusted because the shared generation is unavailable.
+    """
+    if Config.query_cache_generation is None:
+        return True
+    try:
+        generation = await Config.query_cache_generation.get()
+    except RedisError as e:
+        logger.warning("Query cache generation unavailable, skipping the cache: %s", e)
+        return False
+    query_cache.sync(generation)
+    return True
+
+
+async def invalidate_query_cache():
+    """
+    Invalidates the query cache of this worker and, through Redis, of all other workers.
+    """
+    query_cache.clear()
+    if Config.query_cache_generation is not None:
+        try:
+            await Config.query_cache_generation.bump()
+        except RedisError as e:
+            logger.warning("Failed to invalidate the query cache of other workers: %s", e)
+
 
 # Root endpoint
 @app.get("/")
 async def root():
-    return JSONResponse(content={"message": "Welcome to the RAG Service API!"})
+    return ORJSONResponse(content={"message": "Welcome to the RAG Service API!"})
 
 
 @app.post(
@@ -65,43 +128,46 @@ async def upload_file(file: UploadFile = File(...)):
     Raises:
     - 400: If the uploaded file type is unsupported.
     """
-    # Read the uploaded file content
-    file_content = await file.read()
-
-    # Extract text from the file
-    extracted_text = ""
+    # Pick the text extractor for the file type
     if file.filename.endswith(".pdf"):
-        extracted_text = extract_pdf_text(file_content)
+        extract_text = extract_pdf_text
     elif file.filename.endswith(".docx"):
-        extracted_text = extract_docx_text(file_content)
+        extract_text = extract_docx_text
     elif file.filename.endswith(".txt"):
-        extracted_text = extract_txt_text(file_content)
+        extract_text = extract_txt_text
     else:
         raise HTTPException(status_code=400, detail="Unsupported file type")
 
+    # Copy the upload into a temporary file on disk and extract text from it, without loading
+    # the whole file into memory and off the event loop so other requests keep being served
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(file.filename)[1]) as tmp_file:
+        await file.seek(0)
+        await asyncio.to_thread(shutil.copyfileobj, file.file, tmp_file, Config.UPLOAD_COPY_BUFFER_SIZE)
+        tmp_file.flush()
+        extracted_text = await asyncio.to_thread(extract_text, tmp_file.name)
+
     # Preprocess the extracted text
-    preprocessed_text = preprocess_text(extracted_text)
+    preprocessed_text = await asyncio.to_thread(preprocess_text, extracted_text)
 
     # Split the preprocessed text into chunks
-    text_chunks = chunk_text(preprocessed_text)
+    text_chunks = await asyncio.to_thread(chunk_text, preprocessed_text)
+
+    # Embed all chunks in concurrent batched requests, skipping chunks with a cached embedding
+    vectors = await embed_documents(text_chunks)
 
     # Store each chunk as a vector in Pinecone
-    document_ids = []
-    documents = []
-    for chunk in text_chunks:
-        documents.append(
-            Document(
-                page_content=chunk,
-                metadata={"source": file.filename},
-            )
-        )
-        document_ids.append(str(uuid4()))
+    document_ids = [str(uuid4()) for _ in text_chunks]
+    await upsert_vectors([
+        (document_id, vector, {"source": file.filename, "text": chunk})
+        for document_id, vector, chunk in zip(document_ids, vectors, text_chunks)
+    ])
 
-    response = Config.pinecone_vector_store_client.add_documents(documents=documents, ids=document_ids)
+    # Cached search results no longer reflect the index contents
+    await invalidate_query_cache()
 
     return {
         "message": "File uploaded, content extracted, and stored in Pinecone successfully!",
-        "stored_chunks_ids": response,
+        "stored_chunks_ids": document_ids,
     }
 
 
@@ -116,9 +182,10 @@ async def chat(websocket: WebSocket):
 
     This endpoint allows real-time communication between the client and the server using WebSocket.
     Clients can send a message, and the server processes it to:
-    - Perform a similarity search using Pinecone to retrieve context from a vector store.
+    - Perform a similarity search using Pinecone to retrieve context from a vector store, reusing
+      cached results for near-duplicate messages.
     - Include historical chat context for improved responses.
-    - Generate a response using the `llm_chat_chain` function.
+    - Generate a response using the `llm_chat_stream` function, streaming it back token by token.
 
     Args:
     - websocket (WebSocket): The WebSocket connection object.
@@ -127,7 +194,8 @@ async def chat(websocket: WebSocket):
     1. The client sends a message to the server.
     2. The server retrieves relevant context from Pinecone.
     3. The server processes the message along with the retrieved context and chat history.
-    4. The server sends the generated response back to the client.
+    4. The server streams the generated response back to the client as it is generated, one or more
+       text frames followed by a `Config.END_OF_RESPONSE` frame.
     5. The conversation history is updated.
 
     Raises:
@@ -137,36 +205,56 @@ async def chat(websocket: WebSocket):
     - This endpoint is designed for real-time interactions and will not appear in FastAPI's OpenAPI documentation.
     """
     await websocket_manager.connect(websocket)
-    history_data: Dict[str, str] = {}  # Stores conversation history
+    # Stores the most recent (question, response) pairs of the conversation
+    history_data: Deque[Tuple[str, str]] = deque(maxlen=Config.CHAT_HISTORY_SIZE)
 
     try:
         while True:
             # Receive the user's message
             message = await websocket.receive_text()
 
-            # Perform a similarity search to fetch relevant context
-            results = Config.pinecone_vector_store_client.similarity_search(
-                message,
-                k=2  # Retrieve top 2 most similar results
-            )
+            # Embed the message once, for both the cache lookup and the similarity search
+            query_vector = await Config.embedding_client.aembed_query(message)
+
+            # Reuse the results of a near-duplicate query, or perform a similarity search to fetch relevant context.
+            # The cache scan holds a lock and is CPU-bound, so it runs off the event loop
+            use_cache = await sync_query_cache()
+            # Read before searching, so results fetched across an upload are not cached
+            cache_epoch = query_cache.epoch
+            results = await asyncio.to_thread(query_cache.get, query_vector) if use_cache else None
+            if results is None:
+                results = await asyncio.to_thread(
+                    Config.pinecone_vector_store_client.similarity_search_by_vector,
+                    query_vector,
+                    k=2  # Retrieve top 2 most similar results
+                )
+                if use_cache:
+                    await asyncio.to_thread(query_cache.set, query_vector, results, cache_epoch)
 
             # Build context from the search results
-            context = ""
-            for count, res in enumerate(results, 1):
-                context += f"Context {count}: {res.page_content}\n\n"
+            context = "\n\n".join(f"Context {count}: {res.page_content}" for count, res in enumerate(results, 1))
 
             # Build chat history
-            history = ""
-            for count, (question, response) in enumerate(history_data.items(), 1):
-                history += f"({count})\nQuestion: {question}\nResponse: {response}\n\n"
+            history = "\n\n".join(
+                f"({count})\nQuestion: {question}\nResponse: {response}"
+                for count, (question, response) in enumerate(history_data, 1)
+            )
 
-            # Generate a response using the LLM chat chain
-            response = llm_chat_chain(query=message, history=history, context=context)
+            # Generate a response using the LLM chat chain, sending tokens back to the client as they arrive
+            response_parts = []
+            async for token in llm_chat_stream(query=message, history=history, context=context):
+                await websocket_manager.send_message(token, websocket)
+                response_parts.append(token)
+            response = "".join(response_parts)
 
-            # Update conversation history
-            history_data[message] = response
+            # Tell the client the response is complete
+            await websocket_manager.send_message(Config.END_OF_RESPONSE, websocket)
 
-            # Send the response back to the client
-            await websocket_manager.send_message(response, websocket)
+            # Update conversation history
+            history_data.append((message, response))
     except WebSocketDisconnect:
         websocket_manager.disconnect(websocket)
+
+
+if __name__ == "__main__":
+    uvicorn.run("src.app:app", host="0.0.0.0", port=8000, loop="uvloop", http="httptools", workers=Config.WORKERS)
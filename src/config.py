@@ -15,9 +15,51 @@ class Config:
     # Pinecone clients
     PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
     INDEX_NAME = "document-index"
+    # Pod type for a pod-based index (e.g. "p2.x1"); a serverless index is created when unset
+    PINECONE_POD_TYPE = os.getenv("PINECONE_POD_TYPE")
+    PINECONE_ENVIRONMENT = os.getenv("PINECONE_ENVIRONMENT", "us-east-1-aws")
     pinecone_client = None
     pinecone_vector_store_client = None
 
+    # Persistent embedding cache, enabled when REDIS_URL is set
+    REDIS_URL = os.getenv("REDIS_URL")
+    REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 0.5))  # In seconds
+    REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", 0.5))  # In seconds
+    query_cache_generation = None  # Shares query cache invalidations between workers
+    EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", 30 * 24 * 60 * 60))  # In seconds
+    embedding_cache = None
+
+    # Document chunking (in characters)
+    CHUNK_SIZE = 3500
+    CHUNK_OVERLAP = 200
+
+    # Buffer size used when copying uploads to disk
+    UPLOAD_COPY_BUFFER_SIZE = 1 << 20
+
+    # Batch sizes for embedding and upserting document chunks
+    EMBEDDING_BATCH_SIZE = 512
+    EMBEDDING_CONCURRENCY = 5  # Maximum number of embedding requests in flight
+    UPSERT_BATCH_SIZE = 32
+    UPSERT_CONCURRENCY = 8  # Maximum number of upsert requests in flight
+
+    # Number of uvicorn worker processes, read the same way uvicorn does
+    WORKERS = int(os.getenv("WEB_CONCURRENCY", 1))
+
+    # Semantic cache for similarity search results
+    QUERY_CACHE_MAX_SIZE = int(os.getenv("QUERY_CACHE_MAX_SIZE", 2000))  # 0 disables the cache
+    QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", 3600))  # In seconds
+    QUERY_CACHE_THRESHOLD = float(os.getenv("QUERY_CACHE_THRESHOLD", 0.97))
+
+    # Frame sent over the chat WebSocket after the last token of each response
+    END_OF_RESPONSE = "[END_OF_RESPONSE]"
+
+    # Number of previous question/response pairs included in the chat prompt
+    CHAT_HISTORY_SIZE = int(os.getenv("CHAT_HISTORY_SIZE", 10))
+
+    # Cache for LLM responses
+    LLM_CACHE_MAX_SIZE = int(os.getenv("LLM_CACHE_MAX_SIZE", 1024))
+    LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 6 * 60 * 60))  # In seconds
+
     # OpenAI Clients
     embedding_client = OpenAIEmbeddings(model='text-embedding-3-large')
     chat_client = ChatOpenAI(model_name="gpt-4o", temperature=0.5)
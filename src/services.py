@@ -1,10 +1,19 @@
+from collections import OrderedDict
 from fastapi import WebSocket
-from typing import List
+from typing import Any, List, Optional, Sequence, Tuple
+import hashlib
+import logging
+import threading
 import time
 
+import numpy as np
+import redis.asyncio as redis
+from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings
 from langchain_pinecone import PineconeVectorStore
-from pinecone import Pinecone, ServerlessSpec, Index
+from pinecone import Pinecone, PodSpec, ServerlessSpec, Index
+
+logger = logging.getLogger(__name__)
 
 
 class WebsocketManager:
@@ -35,10 +44,22 @@ class PineconeService:
     Manages Pinecone connections and setup.
     """
 
-    def __init__(self, pinecone_api_key: str, index_name: str, embedding_client: OpenAIEmbeddings):
+    def __init__(self, pinecone_api_key: str, index_name: str, embedding_client: OpenAIEmbeddings,
+                 pod_type: Optional[str] = None, environment: Optional[str] = None):
         self.pinecone_api_key = pinecone_api_key
         self.index_name = index_name
         self.embedding_client = embedding_client
+        self.pod_type = pod_type
+        self.environment = environment
+
+    def index_spec(self):
+        """
+        Returns the spec for a new index: pod-based when a pod type is configured
+        (e.g. `p2.x1` for lower query latency), serverless otherwise.
+        """
+        if self.pod_type:
+            return PodSpec(environment=self.environment, pod_type=self.pod_type)
+        return ServerlessSpec(cloud="aws", region="us-east-1")
 
     def initialize_pinecone(self):
         """
@@ -53,7 +74,7 @@ class PineconeService:
                 self.index_name,
                 dimension=3072,  # For text-embedding-3-large model
                 metric="cosine",
-                spec=ServerlessSpec(cloud="aws", region="us-east-1"),
+                spec=self.index_spec(),
             )
             # Wait for the index to be ready
             while not pc.describe_index(self.index_name).status["ready"]:
@@ -72,6 +93,237 @@ class PineconeService:
         return PineconeVectorStore(index=pinecone_client, embedding=self.embedding_client)
 
 
+class QueryCache:
+    """
+    Caches similarity search results keyed by the query embedding.
+
+    A lookup is a hit when the cosine similarity between the query and a cached query
+    reaches the threshold. Vectors are L2-normalized once, on insert and on lookup, so
+    the similarity is a plain dot product. Entries expire after `ttl` seconds and the
+    least recently used entry is evicted once `max_size` is reached. A `max_size` of 0
+    or less disables the cache.
+    """
+
+    def __init__(self, max_size: int = 2000, ttl: float = 3600, threshold: float = 0.97, dimension: int = 3072):
+        self.max_size = max(max_size, 0)
+        self.ttl = ttl
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        # Incremented by every `clear`, so results fetched before an invalidation are never stored after it
+        self.epoch = 0
+        self._lock = threading.RLock()
+        # Row `slot` of the matrix holds the normalized embedding of the entry stored in that slot,
+        # and `_expiries[slot]` its expiry time (infinity for free slots). The matrix is deliberately float32:
+        # numpy has no float16/int8 BLAS path, so narrower storage measured several times slower to scan
+        self._vectors = np.zeros((self.max_size, dimension), dtype=np.float32)
+        self._expiries = np.full(self.max_size, np.inf)
+        # Number of leading rows that have ever held an entry; rows past it are never scanned
+        self._used_rows = 0
+        self._entries: "OrderedDict[int, List[Document]]" = OrderedDict()
+        self._free_slots: List[int] = list(range(self.max_size - 1, -1, -1))
+        # Shared generation the cached entries belong to, see `sync`
+        self._generation: Optional[int] = None
+
+    def get(self, query_vector: Sequence[float]) -> Optional[List[Document]]:
+        """
+        Returns the cached results of the most similar query, or None on a miss.
+        """
+        if self.max_size == 0:
+            return None
+
+        with self._lock:
+            self._evict_expired()
+            if self._entries:
+                similarities = self._similarities(self._normalize(query_vector))
+                slot = int(similarities.argmax())
+                if similarities[slot] >= self.threshold and slot in self._entries:
+                    self._entries.move_to_end(slot)
+                    self.hits += 1
+                    logger.debug("Query cache hit (hits=%d, misses=%d)", self.hits, self.misses)
+                    return self._entries[slot]
+            self.misses += 1
+            logger.debug("Query cache miss (hits=%d, misses=%d)", self.hits, self.misses)
+            return None
+
+    def set(self, query_vector: Sequence[float], results: List[Document], epoch: int):
+        """
+        Stores the results for the given query vector. `epoch` is the value of `self.epoch` read before
+        the results were fetched; if the cache was cleared since, the results may be stale and are dropped.
+        """
+        if self.max_size == 0:
+            return
+
+        with self._lock:
+            if epoch != self.epoch:
+                return
+            if not self._free_slots:
+                self._evict(next(iter(self._entries)))
+            slot = self._free_slots.pop()
+            self._vectors[slot] = self._normalize(query_vector)
+            self._expiries[slot] = time.monotonic() + self.ttl
+            self._used_rows = max(self._used_rows, slot + 1)
+            self._entries[slot] = results
+
+    def sync(self, generation: int):
+        """
+        Invalidates all cached entries if the shared generation changed since the last sync.
+        """
+        with self._lock:
+            if generation != self._generation:
+                self.clear()
+                self._generation = generation
+
+    def clear(self):
+        """
+        Invalidates all cached entries.
+        """
+        with self._lock:
+            self.epoch += 1
+            self._vectors.fill(0)
+            self._expiries.fill(np.inf)
+            self._used_rows = 0
+            self._entries.clear()
+            self._free_slots = list(range(self.max_size - 1, -1, -1))
+
+    @staticmethod
+    def _normalize(vector: Sequence[float]) -> np.ndarray:
+        vector = np.array(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+
+    def _similarities(self, query_vector: np.ndarray) -> np.ndarray:
+        # A single BLAS matrix-vector product over the contiguous rows in use
+        return self._vectors[:self._used_rows] @ query_vector
+
+    def _evict_expired(self):
+        # Expired rows are zeroed before the scan, so they can never shadow a live match
+        for slot in np.flatnonzero(self._expiries[:self._used_rows] <= time.monotonic()):
+            self._evict(int(slot))
+
+    def _evict(self, slot: int):
+        del self._entries[slot]
+        self._vectors[slot] = 0
+        self._expiries[slot] = np.inf
+        self._free_slots.append(slot)
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache with a per-entry TTL.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 6 * 60 * 60, name: str = "response"):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._entries: "OrderedDict[Any, Tuple[Any, float]]" = OrderedDict()
+
+    def get(self, key) -> Optional[Any]:
+        """
+        Returns the cached value for the key, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() < entry[1]:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                logger.debug("%s cache hit (hits=%d, misses=%d)", self.name, self.hits, self.misses)
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            logger.debug("%s cache miss (hits=%d, misses=%d)", self.name, self.hits, self.misses)
+            return None
+
+    def set(self, key, value):
+        """
+        Stores the value under the key, evicting the least recently used entry if the cache is full.
+        """
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Invalidates all cached entries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class CacheGeneration:
+    """
+    Generation counter in Redis shared by all workers.
+
+    A worker bumps it after changing the index, and every worker drops its in-memory
+    query cache once it sees a new value.
+    """
+
+    def __init__(self, redis_url: str, key: str = "query_cache:generation", socket_timeout: float = 0.5,
+                 socket_connect_timeout: float = 0.5):
+        # Short timeouts, so a stalled Redis raises instead of hanging every chat turn
+        self.redis_client = redis.from_url(redis_url, socket_timeout=socket_timeout,
+                                           socket_connect_timeout=socket_connect_timeout)
+        self.key = key
+
+    async def get(self) -> int:
+        return int(await self.redis_client.get(self.key) or 0)
+
+    async def bump(self):
+        await self.redis_client.incr(self.key)
+
+
+class EmbeddingCache:
+    """
+    Persists chunk embeddings in Redis, keyed by the embedding model and a hash of the chunk content.
+
+    Embeddings are stored as float16 bytes to halve storage and transfer size, and expire after `ttl` seconds.
+    """
+
+    def __init__(self, redis_url: str, embedding_client: OpenAIEmbeddings, ttl: int = 30 * 24 * 60 * 60,
+                 socket_timeout: float = 0.5, socket_connect_timeout: float = 0.5):
+        # Short timeouts, so a stalled Redis raises and the upload falls back to embedding everything
+        self.redis_client = redis.from_url(redis_url, socket_timeout=socket_timeout,
+                                           socket_connect_timeout=socket_connect_timeout)
+        # Vectors from another model or dimension count must never be returned
+        self.prefix = f"emb:{embedding_client.model}:{embedding_client.dimensions or 'default'}:"
+        self.ttl = ttl
+
+    def key(self, text: str) -> str:
+        return self.prefix + hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    async def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        Returns the cached embedding of each text, or None for the texts that are not cached.
+        """
+        if not texts:
+            return []
+        blobs = await self.redis_client.mget([self.key(text) for text in texts])
+        return [
+            np.frombuffer(blob, dtype=np.float16).astype(np.float32).tolist() if blob is not None else None
+            for blob in blobs
+        ]
+
+    async def set_many(self, texts: List[str], vectors: List[List[float]]):
+        """
+        Stores the embedding of each text.
+        """
+        if not texts:
+            return
+        async with self.redis_client.pipeline(transaction=False) as pipeline:
+            for text, vector in zip(texts, vectors):
+                pipeline.set(self.key(text), np.asarray(vector, dtype=np.float16).tobytes(), ex=self.ttl)
+            await pipeline.execute()
+
+
 class OpenAIService:
     """
     Manages OpenAI connections and setup.
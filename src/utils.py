@@ -1,75 +1,165 @@
-import io
+import asyncio
+import hashlib
+import logging
+import random
 import re
+from typing import AsyncIterator, List
 
 import docx
 import fitz
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnableMap
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from redis import RedisError
 
 from src.config import Config
+from src.services import ResponseCache
 
+logger = logging.getLogger(__name__)
 
-def llm_chat_chain(query: str, context: str, history: str):
-    template = """Answer the question based only on the following context and history:
+# Regex used on every chat message, compiled once
+_WS_RE = re.compile(r'\s+')
+
+# A line break followed by a blank (or whitespace-only) line, separating paragraphs
+_PARAGRAPH_BREAK_RE = re.compile(r'\n[^\S\n]*\n')
+
+# Splitter used to chunk uploaded documents, built once
+_TEXT_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=Config.CHUNK_SIZE,
+    chunk_overlap=Config.CHUNK_OVERLAP,
+    separators=["\n\n", "\n", ". ", " ", ""],
+)
+
+# Chat prompt and chain, built once and reused for every message
+TEMPLATE = """Answer the question based only on the following context and history:
     Context : {context}
     History : {history}
 
     Question: {question}
     """
-    prompt = ChatPromptTemplate.from_template(template)
-    output_parser = StrOutputParser()
-    chain = RunnableMap({
-        "context": lambda x: context,
-        "question": lambda x: x["question"],
-        "history": lambda x: history
-    }) | prompt | Config.chat_client | output_parser
-    response = chain.invoke({"question": query})
-    return response
+_PROMPT = ChatPromptTemplate.from_template(TEMPLATE)
+_CHAIN = _PROMPT | Config.chat_client | StrOutputParser()
+
+# Cache for LLM responses, keyed by the normalized query, context and recent history
+llm_response_cache = ResponseCache(max_size=Config.LLM_CACHE_MAX_SIZE, ttl=Config.LLM_CACHE_TTL, name="LLM response")
+
+
+# Function to build the LLM response cache key
+def llm_cache_key(query: str, context: str, history: str) -> tuple:
+    return (
+        _WS_RE.sub(' ', query.lower().strip()),
+        hashlib.blake2b(context.encode(), digest_size=16).digest(),
+        hashlib.blake2b(history[-2000:].encode(), digest_size=16).digest(),
+    )
+
+
+# Function to stream the LLM response token by token
+async def llm_chat_stream(query: str, context: str, history: str) -> AsyncIterator[str]:
+    cache_key = llm_cache_key(query, context, history)
+    cached_response = llm_response_cache.get(cache_key)
+    if cached_response is not None:
+        yield cached_response
+        return
+
+    response_parts = []
+    async for token in _CHAIN.astream({"question": query, "context": context, "history": history}):
+        if token:
+            response_parts.append(token)
+            yield token
+    llm_response_cache.set(cache_key, "".join(response_parts))
+
+
+# Function to embed text chunks, reusing cached embeddings of previously seen chunks
+async def embed_documents(texts: List[str]) -> List[List[float]]:
+    if Config.embedding_cache is None:
+        return await embed_documents_batched(texts)
+
+    try:
+        vectors = await Config.embedding_cache.get_many(texts)
+    except RedisError as e:
+        # The cache is optional, so an unavailable Redis must not fail the upload
+        logger.warning("Embedding cache lookup failed, embedding all chunks: %s", e)
+        return await embed_documents_batched(texts)
+
+    # Embed each distinct missing chunk once
+    missing_texts = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+    if missing_texts:
+        missing_vectors = await embed_documents_batched(missing_texts)
+        try:
+            await Config.embedding_cache.set_many(missing_texts, missing_vectors)
+        except RedisError as e:
+            logger.warning("Embedding cache store failed: %s", e)
+        embedded = dict(zip(missing_texts, missing_vectors))
+        vectors = [embedded[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+    return vectors
+
+
+# Function to embed text chunks with concurrent batched requests
+async def embed_documents_batched(texts: List[str]) -> List[List[float]]:
+    batch_size = Config.EMBEDDING_BATCH_SIZE
+    semaphore = asyncio.Semaphore(Config.EMBEDDING_CONCURRENCY)
+
+    async def embed_batch(batch: List[str]) -> List[List[float]]:
+        async with semaphore:
+            # Small jitter so batches don't hit the rate limiter all at once
+            await asyncio.sleep(random.random() * 0.02)
+            return await Config.embedding_client.aembed_documents(batch, chunk_size=batch_size)
+
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    # gather preserves the order of the batches
+    return [vector for batch_vectors in results for vector in batch_vectors]
+
+
+# Function to upsert vectors into Pinecone with concurrent batched requests
+async def upsert_vectors(vectors: List[tuple]):
+    batch_size = Config.UPSERT_BATCH_SIZE
+    semaphore = asyncio.Semaphore(Config.UPSERT_CONCURRENCY)
+
+    async def upsert_batch(batch: List[tuple]):
+        async with semaphore:
+            await asyncio.to_thread(Config.pinecone_client.upsert, vectors=batch)
+
+    await asyncio.gather(*(upsert_batch(vectors[i:i + batch_size]) for i in range(0, len(vectors), batch_size)))
 
 
 # Function to extract text from a PDF file
-def extract_pdf_text(pdf_file: bytes) -> str:
+def extract_pdf_text(pdf_path: str) -> str:
     try:
-        # Open the PDF file from the byte stream
-        with fitz.open(stream=pdf_file, filetype="pdf") as pdf_document:
-            text = ""
-            for page_num in range(pdf_document.page_count):
-                page = pdf_document.load_page(page_num)
-                text += page.get_text("text")
-            return text
+        # Open the PDF file from disk, letting PyMuPDF read pages on demand
+        with fitz.open(pdf_path, filetype="pdf") as pdf_document:
+            pages = [pdf_document.load_page(page_num).get_text("text") for page_num in range(pdf_document.page_count)]
+            return "".join(pages)
     except Exception as e:
         raise ValueError(f"Error processing PDF file: {e}")
 
 
 # Function to extract text from a DOCX file
-def extract_docx_text(docx_file: bytes) -> str:
-    doc = docx.Document(io.BytesIO(docx_file))
-    text = ""
-    for para in doc.paragraphs:
-        text += para.text + "\n"
-    return text
+def extract_docx_text(docx_path: str) -> str:
+    doc = docx.Document(docx_path)
+    return "\n".join(para.text for para in doc.paragraphs)
 
 
 # Function to extract text from a TXT file
-def extract_txt_text(txt_file: bytes) -> str:
-    text = txt_file.decode("utf-8")
-    return text
+def extract_txt_text(txt_path: str) -> str:
+    with open(txt_path, encoding="utf-8") as txt_file:
+        return txt_file.read()
 
 
 # Function to split long text into chunks for better embedding
-def chunk_text(text: str, chunk_size: int = 3500) -> list:
-    # Split text into smaller chunks
-    chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
-    return chunks
+def chunk_text(text: str) -> List[str]:
+    # Split text into overlapping chunks on paragraph, sentence and word boundaries
+    return _TEXT_SPLITTER.split_text(text)
 
 
-# Preprocess the text data by removing unwanted characters and tokenizing
+# Preprocess the text data by normalizing whitespace
 def preprocess_text(text: str) -> str:
-    # Remove extra newlines, tabs, and spaces
-    text = re.sub(r'\s+', ' ', text)
-    text = text.strip()
-    # Further preprocessing, like removing special characters, stopwords, etc.
-    # Remove punctuation
-    text = re.sub(r'[^\w\s]', '', text)
-    return text
+    # Collapse extra spaces and tabs within each line and drop empty lines, but keep line and paragraph
+    # breaks so the text splitter can cut on them; punctuation is kept as it helps the embedding model
+    paragraphs = []
+    for paragraph in _PARAGRAPH_BREAK_RE.split(text):
+        lines = (" ".join(line.split()) for line in paragraph.splitlines())
+        paragraph = "\n".join(line for line in lines if line)
+        if paragraph:
+            paragraphs.append(paragraph)
+    return "\n\n".join(paragraphs)